@@ -12,32 +12,76 @@ import argparse
 import os
 import logging
 import re
-import urllib.request, urllib.error
+import urllib.parse
 import requests
-import dateutil.parser
-import pytz
+import requests.adapters
+from selectolax.lexbor import LexborHTMLParser
+import datetime
 import inspect
 from pprint import pprint
 import subprocess
+import concurrent.futures
+import collections
+import shutil
+
+# KML generator for the speed limit CSVs. Run it in-process when it can be imported (saves an
+#       interpreter startup per state and lets it share our HTTP session), otherwise shell out
+_SEGMENTCSV2KML_DIR = '/home/tdo/projects/segmentcsv2kml'
+
+# One session for the whole crawl so every page under the root URL reuses
+#       pooled keep-alive connections instead of a fresh TCP/TLS handshake
+_SESSION = requests.Session()
+_SESSION.headers['User-Agent'] = 'Mozilla/5.0'
+for _prefix in ( 'http://', 'https://' ):
+    _SESSION.mount( _prefix, requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32,
+        max_retries=2) )
+
+# Timestamps from previous runs live next to the script, so it works no matter where cron starts it
+_TIMESTAMP_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'timestamp_archive')
+
+# Largest page we'll read; content is kept as undecoded bytes and handed straight to the parser
+_MAX_HTML_BYTES = 8 << 20
+
+# Sibling pages are fetched in parallel, bounded well under the session's connection pool size
+_MAX_FETCH_WORKERS = 8
 
 def main():
     logging.basicConfig(level=logging.INFO)
     args = parseArgs()
 
-    previousDataTimestamp = getPreviousDataTimestamp()
-    indexHtmlContent = getHtmlContent(args.rootUrl)
+    (previousDataTimestamp, previousCacheValidators) = getPreviousDataTimestamp()
+
+    # Cheap HEAD first; if the server says the index hasn't changed, we're done
+    (indexModified, currCacheValidators) = checkIndexModified(args.rootUrl,
+        previousDataTimestamp, previousCacheValidators)
+
+    if indexModified is False:
+        sys.exit()
+
+    # Index page is processed under its final URL, so its links resolve correctly if the root redirects
+    (indexUrl, indexHtmlContent) = getHtmlPage(args.rootUrl)
+
+    # Parse the index page once; the tree is reused for the timestamp and link discovery
+    indexHtmlTree = LexborHTMLParser(indexHtmlContent)
 
     # Get data timestamp from contents of the index page
-    currTimestamp = parseDataTimestampFromIndexPage(indexHtmlContent)
+    currTimestamp = parseDataTimestampFromIndexPage(indexHtmlTree)
 
     if _needToDoRun(previousDataTimestamp, currTimestamp) is False:
+        # Page was re-served with the same data; keep its new validators so the next run can
+        #       still get a 304 instead of repeating the full fetch. If the HEAD didn't give us
+        #       any, leave the stored ones alone
+        if currCacheValidators is not None:
+            writeCacheValidatorsToArchive(previousDataTimestamp, currCacheValidators)
         sys.exit()
 
-    # Process the content at the index page (link depth = 1)
-    processContent(indexHtmlContent, args.rootUrl, 1, args.stateOutputDir, currTimestamp)
+    # Crawl the site starting from the index page (link depth = 1)
+    crawl(indexUrl, indexHtmlContent, indexHtmlTree, args.stateOutputDir, currTimestamp)
 
-    # Write the timestamp to the archive
-    writeTimestampToArchive(currTimestamp)
+    # Write the timestamp (and the validators for the next conditional request) to the archive
+    if currCacheValidators is None:
+        currCacheValidators = {}
+    writeTimestampToArchive(currTimestamp, currCacheValidators)
 
 
 def _needToDoRun(previousDataTimestamp, currTimestamp):
@@ -53,7 +97,7 @@ def _needToDoRun(previousDataTimestamp, currTimestamp):
     # If we get here, pull all the data
     logging.getLogger(__name__).info('Previous timestamp of ' +
         prettyPrintTimestamp(previousDataTimestamp) + ' < ' +
-        prettyPrintTimestamp(currentTimestamp) +
+        prettyPrintTimestamp(currTimestamp) +
         ' indicates we need to do complete run!')
 
     return True 
@@ -84,49 +128,150 @@ def validateArgs(args):
         sys.exit(-1)
 
 
+# Sidecar files stored next to each .timestamp file, holding the HTTP cache validators
+#       the server returned for the index page on that run
+_CACHE_VALIDATOR_EXTENSIONS = { 'ETag': '.etag', 'Last-Modified': '.lastmodified' }
+
+
+# Returns a tuple of whether the index page may have changed, and the cache validators to store
+#       for it (None if the HEAD didn't succeed, so there's nothing new worth storing)
+
+def checkIndexModified(rootUrl, previousDataTimestamp, previousCacheValidators):
+    log = logging.getLogger(__name__)
+
+    requestHeaders = {}
+    if 'ETag' in previousCacheValidators:
+        requestHeaders['If-None-Match'] = previousCacheValidators['ETag']
+    if 'Last-Modified' in previousCacheValidators:
+        requestHeaders['If-Modified-Since'] = previousCacheValidators['Last-Modified']
+    elif previousDataTimestamp is not None:
+        requestHeaders['If-Modified-Since'] = previousDataTimestamp.strftime(
+            '%a, %d %b %Y %H:%M:%S GMT')
+
+    try:
+        response = _SESSION.head(rootUrl, headers=requestHeaders, timeout=30, allow_redirects=True)
+    except requests.exceptions.RequestException as e:
+        # Not fatal, the full GET will report anything that's really wrong
+        log.warning('Conditional HEAD of ' + rootUrl + ' failed, falling back to full fetch')
+        return (True, None)
+
+    if response.status_code == 304:
+        log.info('Index page ' + rootUrl + ' not modified since last run, nothing to retrieve')
+        return (False, previousCacheValidators)
+
+    # Validators on an error page (or anything else that isn't the index itself) mean nothing
+    if response.status_code != 200:
+        log.warning('Conditional HEAD of ' + rootUrl + ' returned {0}, not storing its cache '
+            'validators'.format(response.status_code))
+        return (True, None)
+
+    currCacheValidators = {}
+    for currHeader in _CACHE_VALIDATOR_EXTENSIONS:
+        if currHeader in response.headers:
+            currCacheValidators[currHeader] = response.headers[currHeader]
+
+    return (True, currCacheValidators)
+
+
 def getPreviousDataTimestamp():
-    timestampArchiveDir = os.getcwd() + '/timestamp_archive'
+    timestampArchiveDir = _TIMESTAMP_ARCHIVE_DIR
     # If timestamp archive dir doesn't exist, create it
     if os.path.isdir(timestampArchiveDir) is False:
         os.makedirs(timestampArchiveDir)
         logging.getLogger(__name__).info( "Created directory \"" +
             timestampArchiveDir + "\" for timestamps" )
 
-    # Walk through timestamps, if any, and pull most recent
-    dataTimestamps = []
+    _migrateLegacyTimestampArchive(timestampArchiveDir)
+
+    # Walk through timestamps, if any, and pull most recent. Archive filenames are zero-padded
+    #       "YYYY-MM-DD HH:MM:SS", so walking them in descending order the first one that parses
+    #       is the most recent, and normally it's the only one that needs parsing
     timestampFileExtension = '.timestamp'
-    for currFile in os.listdir(timestampArchiveDir):
+    timestampFiles = []
+    with os.scandir(timestampArchiveDir) as archiveEntries:
+        for currEntry in archiveEntries:
+            if currEntry.name.endswith(timestampFileExtension) is True:
+                timestampFiles.append(currEntry.name)
+            elif currEntry.name.endswith(tuple(_CACHE_VALIDATOR_EXTENSIONS.values())) is False:
+                logging.getLogger(__name__).warning( "Found invalid file \"" +
+                    currEntry.name + "\" in timestamp archive, ignoring" )
+
+    previousDataTimestamp = None
+    for currFile in sorted( timestampFiles, reverse=True ):
         supposedTimestamp = currFile[:len(currFile) - len(timestampFileExtension)]
         logging.getLogger(__name__).debug('Found possible timestamp \"' + 
             supposedTimestamp + "\"")
-        parsedTimestamp = parseTimestamp(supposedTimestamp)
-        if currFile.endswith(timestampFileExtension) is False or \
-                parsedTimestamp == None:
-            logging.getLogger(__name__).warn( "Found invalid file \"" +
+        try:
+            previousDataTimestamp = parseTimestamp(supposedTimestamp)
+            break
+        except ValueError:
+            logging.getLogger(__name__).warning( "Found invalid file \"" +
                 currFile + "\" in timestamp archive, ignoring" )
-            continue
 
-        # Must be valid
-        dataTimestamps.append(parsedTimestamp)
+    if previousDataTimestamp is None:
+        return (None, {})
 
-    if len(dataTimestamps) > 0:
-        return max( dataTimestamps )
-    else:
-        return None
+    # Pull any cache validators saved alongside the most recent timestamp
+    cacheValidators = {}
+    archiveBaseName = os.path.join(timestampArchiveDir, supposedTimestamp)
+    for ( currHeader, currExtension ) in _CACHE_VALIDATOR_EXTENSIONS.items():
+        if os.path.isfile(archiveBaseName + currExtension) is True:
+            with open(archiveBaseName + currExtension) as validatorFile:
+                cacheValidators[currHeader] = validatorFile.read().strip()
+
+    return (previousDataTimestamp, cacheValidators)
+
+
+
+# The archive used to live under the current working directory. If that one exists and the
+#       archive next to the script has no timestamps yet, copy it over so upgrading doesn't
+#       force a complete re-run
+
+def _migrateLegacyTimestampArchive(timestampArchiveDir):
+    log = logging.getLogger(__name__)
 
+    legacyArchiveDir = os.path.join(os.getcwd(), 'timestamp_archive')
+    if os.path.isdir(legacyArchiveDir) is False or \
+            os.path.realpath(legacyArchiveDir) == os.path.realpath(timestampArchiveDir):
+        return
+
+    for currFile in os.listdir(timestampArchiveDir):
+        if currFile.endswith('.timestamp') is True:
+            return
+
+    log.info('Copying timestamps from previous archive location \"' + legacyArchiveDir +
+        '\" to \"' + timestampArchiveDir + '\"')
+    for currFile in os.listdir(legacyArchiveDir):
+        if os.path.isfile(os.path.join(legacyArchiveDir, currFile)) is True:
+            shutil.copy2(os.path.join(legacyArchiveDir, currFile), timestampArchiveDir)
+
+
+# Formats we actually see: the index page's "Generated:" line and the timestamp archive filenames
+_KNOWN_TIMESTAMP_FORMATS = ( '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S' )
 
 
 def parseTimestamp(possibleTimestamp):
     log = logging.getLogger(__name__)
 
-    # Any format that dateutil.parser can parse is good by us, but hoping for ISO8601   
+    # Try the known fixed formats first, they're what we see in practice
+    for currFormat in _KNOWN_TIMESTAMP_FORMATS:
+        try:
+            parsedTimestamp = datetime.datetime.strptime(possibleTimestamp, currFormat)
+        except ValueError:
+            continue
+
+        log.debug("Parsed timestamp \"" + 
+            prettyPrintTimestamp(parsedTimestamp) + "\" out of \"" + possibleTimestamp + "\"")
+
+        return _forceUtc(parsedTimestamp)
+
+    # Otherwise any ISO8601 timestamp is good by us
     try: 
-        parsedTimestamp = dateutil.parser.parse(possibleTimestamp)
+        parsedTimestamp = datetime.datetime.fromisoformat(possibleTimestamp)
         log.debug("Parsed timestamp \"" + 
             prettyPrintTimestamp(parsedTimestamp) + "\" out of \"" + possibleTimestamp + "\"")
 
-        # force timezone to UTC so everything's comparable
-        return pytz.utc.localize(parsedTimestamp)
+        return _forceUtc(parsedTimestamp)
     except ValueError as e:
         log.error('Could not parse timestamp out of ' + possibleTimestamp)
         raise ValueError('Could not parse timestamp from HTML')
@@ -134,37 +279,62 @@ def parseTimestamp(possibleTimestamp):
     return None
 
 
-def getHtmlContent(rootUrl):
+# Force timezone to UTC so everything's comparable. Naive timestamps are taken to already be UTC,
+#       ones carrying an offset get converted rather than relabelled
+
+def _forceUtc(parsedTimestamp):
+    if parsedTimestamp.tzinfo is None:
+        return parsedTimestamp.replace(tzinfo=datetime.timezone.utc)
+
+    return parsedTimestamp.astimezone(datetime.timezone.utc)
+
+
+# Returns a tuple of the page's final URL (after any redirects) and its content
+
+def getHtmlPage(rootUrl):
     log = logging.getLogger(__name__)
     try:
-        with urllib.request.urlopen(urllib.request.Request(rootUrl,
-                 headers={'User-Agent': 'Mozilla/5.0'})) as urlHandle:
+        log.debug('Opening URL ' + rootUrl + ', reading content')
+        with _SESSION.get(rootUrl, timeout=30, stream=True) as response:
+            response.raise_for_status()
+
+            # Session asks for gzip/deflate (and br if brotli is installed); check it's being used
+            log.debug('Content-Encoding for ' + rootUrl + ': ' +
+                response.headers.get('Content-Encoding', 'none'))
 
+            htmlContent = response.raw.read(_MAX_HTML_BYTES + 1, decode_content=True)
+            pageUrl = response.url
 
-            log.debug('Opened URL ' + rootUrl + ', reading content') 
-            htmlContent = urlHandle.read().decode('utf-8')
-            log.debug('Successfully read content')
+        if len(htmlContent) > _MAX_HTML_BYTES:
+            log.warning('Content of ' + rootUrl + ' truncated to {0} bytes'.format(_MAX_HTML_BYTES))
+            htmlContent = htmlContent[:_MAX_HTML_BYTES]
 
-    except urllib.error.HTTPError as e:
+        log.debug('Successfully read content')
+
+    except requests.exceptions.HTTPError as e:
         log.error('HTTP error code {0} returned when accessing {1}'.format(
-            e.code, rootUrl) )
+            e.response.status_code, rootUrl) )
         sys.exit()
-    except urllib.error.URLError as e:
-        log.error('Unable to parse URL ' + rootUrl)
+    except requests.exceptions.ConnectionError as e:
+        log.error('Unable to connect to URL ' + rootUrl)
         sys.exit()
-    except ValueError as e:
+    except ( requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidURL ) as e:
         log.error('Unknown URL type ' + rootUrl)
         sys.exit()
     except:
         log.error('Unknown exception when opening ' + rootUrl )
         sys.exit()
 
-    #log.debug("HTML:\n" + htmlContent)
+    #log.debug("HTML:\n" + htmlContent.decode('utf-8', 'replace'))
+
+    return (pageUrl, htmlContent)
 
-    return htmlContent
 
+_GENERATED_TIMESTAMP_RE = re.compile( 'Generated: (.+?) UTC' )
 
-def parseDataTimestampFromIndexPage(htmlContent):
+
+def parseDataTimestampFromIndexPage(htmlTree):
     # WARNING: fragile-as-hell parsing, but author didn't give much context to work with
     #
     # Goign for the fact that as of this writing, page has:
@@ -175,7 +345,8 @@ def parseDataTimestampFromIndexPage(htmlContent):
 
     log = logging.getLogger(__name__)
 
-    dateMatch = re.search( 'Generated: (.+?) UTC', htmlContent )
+    # Search the page's text rather than the raw HTML, it's a much smaller haystack
+    dateMatch = _GENERATED_TIMESTAMP_RE.search( htmlTree.body.text() )
 
     if dateMatch == None:
         log.error('Could not find possible date string in HTML')
@@ -192,48 +363,114 @@ def prettyPrintTimestamp(timestamp):
     return timestamp.strftime('%Y-%m-%d %H:%M:%S UTC')
 
 
-def processContent(htmlContent, htmlUrl, linkDepth, stateOutputDir, currTimestamp, recurse=True):
+def crawl(rootUrl, rootHtmlContent, rootHtmlTree, stateOutputDir, currTimestamp):
+    log = logging.getLogger(__name__)
+
+    # Breadth-first: all queued pages (one link depth) are fetched concurrently, then scanned one
+    #       at a time on this thread, queueing their unvisited children for the next pass. Pages
+    #       share navigation links, so track every URL seen across the whole crawl
+    visitedUrls = { normalizeUrl(rootUrl) }
+    processedUrls = { normalizeUrl(rootUrl) }
+    pendingUrls = collections.deque()
+
+    childUrls = processContent(rootHtmlContent, rootUrl, 1, stateOutputDir, currTimestamp,
+        htmlTree=rootHtmlTree)
+    _queueUnvisitedUrls(childUrls, 2, visitedUrls, pendingUrls)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_FETCH_WORKERS) as executor:
+        while len(pendingUrls) > 0:
+            currBatch = [ pendingUrls.popleft() for i in range(len(pendingUrls)) ]
+            batchHtmlPages = executor.map(getHtmlPage,
+                [ newUrl for ( newUrl, linkDepth ) in currBatch ])
+
+            for ( ( newUrl, linkDepth ), ( pageUrl, newHtmlContent ) ) in zip(currBatch,
+                    batchHtmlPages):
+                # Links resolve against where the server actually sent us ("sub" redirecting to
+                #       "sub/"), and a redirect can land on a page that's already been processed
+                normalizedPageUrl = normalizeUrl(pageUrl)
+                if normalizedPageUrl in processedUrls:
+                    log.debug('Not processing ' + newUrl + ', ' + pageUrl + ' already processed')
+                    continue
+
+                visitedUrls.add(normalizedPageUrl)
+                processedUrls.add(normalizedPageUrl)
+
+                log.info("Processing " + pageUrl)
+                childUrls = processContent(newHtmlContent, pageUrl, linkDepth, stateOutputDir,
+                    currTimestamp)
+                _queueUnvisitedUrls(childUrls, linkDepth + 1, visitedUrls, pendingUrls)
+
+
+def _queueUnvisitedUrls(newUrls, linkDepth, visitedUrls, pendingUrls):
+    log = logging.getLogger(__name__)
+
+    for newUrl in newUrls:
+        normalizedUrl = normalizeUrl(newUrl)
+        if normalizedUrl in visitedUrls:
+            log.debug('Not queueing link ' + newUrl + ' (already visited)')
+            continue
+
+        visitedUrls.add(normalizedUrl)
+        pendingUrls.append( ( newUrl, linkDepth ) )
+
+
+# Runs all scanners over a page and returns the absolute URLs of the child pages it links to
+
+def processContent(htmlContent, htmlUrl, linkDepth, stateOutputDir, currTimestamp, htmlTree=None):
     log = logging.getLogger(__name__)
 
+    if htmlTree is None:
+        htmlTree = LexborHTMLParser(htmlContent)
+
     (contentScanners, linkScanners) = getContentLinkScanners()
 
+    # Content scanners get the already-parsed tree so no page is parsed more than once, plus the
+    #       raw bytes for any scanner that really needs them
     for currContentScanner in contentScanners:
-        currContentScanner(htmlContent, htmlUrl, linkDepth, stateOutputDir, currTimestamp)
+        currContentScanner(htmlTree, htmlContent, htmlUrl, linkDepth, stateOutputDir, currTimestamp)
 
-    htmlLinks = getHtmlLinks(htmlContent)
+    (htmlLinks, pageLinks) = getHtmlLinks(htmlTree)
 
     for currHtmlLink in htmlLinks:
         log.debug('Found link ' + currHtmlLink + " in " + htmlUrl )
-        for currLinkScanner in linkScanners:
-            currLinkScanner( currHtmlLink, htmlUrl, linkDepth, stateOutputDir, currTimestamp)
-
-    # Should we now dive into child links?
-    if recurse is True:
-        for currHtmlLink in htmlLinks:
-            if htmlUrl.endswith('/') is False:
-                # If the current URL does NOT end in a slash, need to trim off the last token
-                htmlUrl = removeLastToken(htmlUrl)
-
-            parsedHref = parseHref(currHtmlLink)
-
-            newUrl = urllib.parse.urljoin(htmlUrl, urllib.parse.quote(parseHref(currHtmlLink)) )
+        for ( currLinkFilter, currLinkScanner ) in linkScanners:
+            if currLinkFilter(currHtmlLink) is True:
+                currLinkScanner( currHtmlLink, htmlUrl, linkDepth, stateOutputDir, currTimestamp)
+
+    # If the current URL does NOT end in a slash, need to trim off the last token. Only depends
+    #       on the page, so work it out once rather than per link
+    if htmlUrl.endswith('/') is True:
+        baseUrl = htmlUrl
+    else:
+        baseUrl = removeLastToken(htmlUrl)
+
+    childUrls = []
+    for currHtmlLink in pageLinks:
+        # Drop any fragment before quoting, otherwise the '#' is escaped and requested as part of
+        #       the path. A link that's only a fragment points back at this same page
+        linkPath = urllib.parse.urldefrag(currHtmlLink)[0]
+        if len(linkPath) == 0:
+            continue
 
-            if newUrl.endswith('.csv') is True:
-                log.debug('Not recursing into link ' + newUrl + ' (CSV file)')
-                continue
+        childUrls.append( urllib.parse.urljoin(baseUrl, urllib.parse.quote(linkPath)) )
 
-            log.info("Recursing into " + newUrl)
-            newHtmlContent = getHtmlContent(newUrl)
-            processContent( newHtmlContent, newUrl, linkDepth + 1, 
-                stateOutputDir, currTimestamp, recurse)
+    return childUrls
 
 
 # Finds all functions with names that start with "contentScanner_" or "linkScanner_" and
-#       returns a tuple with lists of callable objects that match for each
+#       returns a tuple with lists of callable objects that match for each. Link scanners are
+#       returned as (link filter, scanner) pairs, see linkFilter(). The module's globals don't
+#       change once it's loaded, so the scan only happens on the first call
+
+_contentLinkScanners = None
 
 def getContentLinkScanners():
+    global _contentLinkScanners
     log = logging.getLogger(__name__)
 
+    if _contentLinkScanners is not None:
+        return _contentLinkScanners
+
     contentScanners = []
     linkScanners = []
 
@@ -243,18 +480,35 @@ def getContentLinkScanners():
             log.debug("Found content scanner: " + globalKey )
 
         elif globalKey.startswith('linkScanner_') is True and callable(globalValue) is True:
-            linkScanners.append( globalValue )
+            linkScanners.append( ( getattr(globalValue, 'linkFilter', _acceptAnyLink), globalValue ) )
             log.debug( 'Found link scanner: ' + globalKey )
 
-    return (contentScanners, linkScanners)
+    _contentLinkScanners = (contentScanners, linkScanners)
+
+    return _contentLinkScanners
+
+
+def _acceptAnyLink(linkHref):
+    return True
 
 
-def linkScanner_getAreaManagerPolygons( linkContent, parentUrl, parentLinkDepth, stateOutputDir,
+# Decorator for link scanners: the scanner only gets called for hrefs the predicate accepts,
+#       saves calling every scanner for every link on the page
+
+def linkFilter(predicate):
+    def attachLinkFilter(linkScanner):
+        linkScanner.linkFilter = predicate
+        return linkScanner
+
+    return attachLinkFilter
+
+
+@linkFilter(lambda linkHref: linkHref == 'managedareas.csv')
+def linkScanner_getAreaManagerPolygons( linkHref, parentUrl, parentLinkDepth, stateOutputDir,
         currTimestamp ):
     log = logging.getLogger(__name__)
 
-    if re.search('href\s*=\s*"managedareas.csv"', linkContent) != None and \
-        parentUrl == 'http://db.slickbox.net/states/' and parentLinkDepth == 1:
+    if parentUrl == 'http://db.slickbox.net/states/' and parentLinkDepth == 1:
 
         areaManagerPolygonCsv = parentUrl + 'managedareas.csv'
 
@@ -263,23 +517,19 @@ def linkScanner_getAreaManagerPolygons( linkContent, parentUrl, parentLinkDepth,
     return
 
 
-def linkScanner_getMissingStateSpeedLimits( linkContent, parentUrl, parentLinkDepth, stateOutputDir,
+@linkFilter(lambda linkHref: linkHref.endswith('-sl.csv'))
+def linkScanner_getMissingStateSpeedLimits( linkHref, parentUrl, parentLinkDepth, stateOutputDir,
         currTimestamp ):
     log = logging.getLogger(__name__)
 
-    relativeLink = parseHref(linkContent)
-    if relativeLink.endswith('-sl.csv') is False:
-        return
-
-    mergedUrl = mergeParentAndRelativeUrl(parentUrl, relativeLink)
+    mergedUrl = mergeParentAndRelativeUrl(parentUrl, linkHref)
     
     log.info( "Found state speed limit CSV at " + mergedUrl )
 
     # Find out which state we're working with
 
     # Take last token, trim off known tail of filename
-    urlTokens = mergedUrl.split('/')
-    stateName = urlTokens[len(urlTokens)-1]
+    stateName = mergedUrl.rsplit('/', 1)[-1]
     stateName = stateName[:len(stateName)-len('-sl.csv')]
     
     # Create output directory
@@ -299,38 +549,74 @@ def linkScanner_getMissingStateSpeedLimits( linkContent, parentUrl, parentLinkDe
     else:
         log.warn('Output directory ' + outputDir + ' already existed')
 
-    # Run the KML generator
-    executable = 'python3'
-    script = '/home/tdo/projects/segmentcsv2kml/segmentcsv2kml.py'
-    subprocess.call( ["python3", script, mergedUrl, outputDir] )
+    # Run the KML generator. A failure for one state must not stop the rest of the crawl, same
+    #       as when it only ever ran as a separate process
+    segmentcsv2kml = _getSegmentCsv2Kml()
+    if segmentcsv2kml is not None:
+        try:
+            segmentcsv2kml.run( mergedUrl, outputDir, session=_SESSION )
+        except ( Exception, SystemExit ) as e:
+            log.error('KML generation failed for ' + mergedUrl + ': ' + repr(e))
+    else:
+        script = os.path.join(_SEGMENTCSV2KML_DIR, 'segmentcsv2kml.py')
+        subprocess.call( ["python3", script, mergedUrl, outputDir] )
 
 
-def getHtmlLinks(htmlContent):
+# Imports segmentcsv2kml the first time it's needed. Returns None (shell out instead) if it
+#       can't be imported or has no run() entry point
+
+_segmentCsv2KmlModule = None
+_segmentCsv2KmlImportAttempted = False
+
+def _getSegmentCsv2Kml():
+    global _segmentCsv2KmlModule, _segmentCsv2KmlImportAttempted
     log = logging.getLogger(__name__)
 
-    returnLinks = []
+    if _segmentCsv2KmlImportAttempted is True:
+        return _segmentCsv2KmlModule
 
-    # Only return relative links (remove any with http:// at the beginning)
-    for potentialLink in re.findall( '<a\s+href.*?<\/a>', htmlContent ):
-        hrefPortion = parseHref(potentialLink)
-        if hrefPortion.startswith('http://') is False and \
-                hrefPortion.startswith('https://') is False:
-            returnLinks.append(potentialLink)
-            log.debug("Added " + potentialLink + " as it's relative" )
+    _segmentCsv2KmlImportAttempted = True
+
+    if _SEGMENTCSV2KML_DIR not in sys.path:
+        sys.path.append(_SEGMENTCSV2KML_DIR)
+
+    try:
+        import segmentcsv2kml
+    except ( Exception, SystemExit ) as e:
+        log.info('Could not import segmentcsv2kml (' + repr(e) + '), will run it as a script')
+        return None
+
+    if hasattr(segmentcsv2kml, 'run') is False:
+        log.info('segmentcsv2kml has no run() entry point, will run it as a script')
+        return None
 
-    return returnLinks
+    _segmentCsv2KmlModule = segmentcsv2kml
 
+    return _segmentCsv2KmlModule
 
-def parseHref(htmlLink):
+
+# Returns a tuple with the href values of all relative links (anything not starting with
+#       http:// or https://) for the link scanners, and the subset of those worth recursing
+#       into (CSV files are data, not pages)
+
+def getHtmlLinks(htmlTree):
     log = logging.getLogger(__name__)
 
-    patternMatches = re.search('href\s*=\s*"(.+?)"', htmlLink)
+    returnLinks = []
+    pageLinks = []
 
-    if patternMatches == None:
-        log.error('Could not parse Href value out of ' + htmlLink)
-        sys.exit()
+    for currAnchor in htmlTree.css('a[href]'):
+        potentialLink = currAnchor.attrs.get('href')
+        if potentialLink and potentialLink.startswith(('http://', 'https://')) is False:
+            returnLinks.append(potentialLink)
+            log.debug("Added " + potentialLink + " as it's relative" )
+
+            if potentialLink.endswith('.csv') is True:
+                log.debug('Not recursing into link ' + potentialLink + ' (CSV file)')
+            else:
+                pageLinks.append(potentialLink)
 
-    return patternMatches.group(1)
+    return (returnLinks, pageLinks)
 
 
 def removeLastToken(url):
@@ -338,15 +624,22 @@ def removeLastToken(url):
     # log.debug("Removing last token from " + url)
 
     # delete to last slash
-    for i in range(len(url) - 1, 0, -1):
-        if url[i] == '/':
-            trimmedUrl = url[:i + 1]
-            # log.debug( 'Trimmed URL: ' + trimmedUrl)
-            return trimmedUrl
+    ( urlHead, separator, lastToken ) = url.rpartition('/')
+    if len(urlHead) > 0:
+        trimmedUrl = urlHead + '/'
+        # log.debug( 'Trimmed URL: ' + trimmedUrl)
+        return trimmedUrl
 
     log.error('Should never get here')
     sys.exit()
 
+# Strips any fragment so equivalent URLs compare equal. The trailing slash is kept, "sub" and
+#       "sub/" resolve their relative links against different directories
+
+def normalizeUrl(url):
+    return urllib.parse.urldefrag(url)[0]
+
+
 def mergeParentAndRelativeUrl( parentUrl, relativeUrl ):
 
     if parentUrl.endswith('/'):
@@ -360,10 +653,28 @@ def touch(fname, times=None):
         os.utime(fname, times)
 
 
-def writeTimestampToArchive(currTimestamp):
-    timestampArchiveDir = os.getcwd() + '/timestamp_archive' 
+def writeTimestampToArchive(currTimestamp, cacheValidators):
+    writeCacheValidatorsToArchive(currTimestamp, cacheValidators)
+
+    touch(_getArchiveBaseName(currTimestamp) + '.timestamp')
+
+
+# Saves the validators next to the given timestamp's archive file, replacing any from earlier
+#       responses so a validator the server stopped sending isn't reused
+
+def writeCacheValidatorsToArchive(dataTimestamp, cacheValidators):
+    archiveBaseName = _getArchiveBaseName(dataTimestamp)
+
+    for ( currHeader, currExtension ) in _CACHE_VALIDATOR_EXTENSIONS.items():
+        if currHeader in cacheValidators:
+            with open(archiveBaseName + currExtension, 'w') as validatorFile:
+                validatorFile.write(cacheValidators[currHeader] + '\n')
+        elif os.path.isfile(archiveBaseName + currExtension) is True:
+            os.remove(archiveBaseName + currExtension)
+
 
-    touch(os.path.join(timestampArchiveDir, currTimestamp.strftime('%Y-%m-%d %H:%M:%S.timestamp')))
+def _getArchiveBaseName(dataTimestamp):
+    return os.path.join(_TIMESTAMP_ARCHIVE_DIR, dataTimestamp.strftime('%Y-%m-%d %H:%M:%S'))
 
 
     